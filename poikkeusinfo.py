@@ -5,27 +5,89 @@ Classes for downloading, parsing and filtering poikkeusinfo.fi xml files.
 """
 
 from local_settings import LINES, FETCH_INTERVAL
+import asyncio
+import concurrent.futures
 import datetime
+import functools
 import glob
+import hashlib
+import itertools
 import json
+import pathlib
 import pprint
 import re
-import redis
+import redis.asyncio
 import requests
 import time
 import xmltodict
-import pytz
 import logging
+from zoneinfo import ZoneInfo
+
+
+# Mapping for notification types (see pdf)
+TYPE_MAP = {
+    "1": "advance_info",
+    "2": "urgent_info",
+}
+
+# Mapping for notification sources (see pdf)
+SOURCE_MAP = {
+    "1": "manual",  # manually entered
+    "2": "automatic",  # automatically imported from other HSL systems
+}
+
+# Mapping for line types (see pdf)
+LINETYPE_MAP = {
+    "1": "helsinki",
+    "2": "tram",
+    "3": "espoo",
+    "4": "vantaa",
+    "5": "regional_traffic",
+    "6": "metro",
+    "7": "ferry",
+    "12": "train",
+    "14": "all",
+    "36": "kirkkonummi",
+    "39": "kerava",
+}
+
+# Mapping for departure directions (see pdf)
+DIRECTION_MAP = {
+    "1": "from_centrum",
+    "2": "to_centrum",
+}
+
+
+class HashingStreamReader(object):
+    """ File-like object reading from an iterator of byte chunks, such as a streamed HTTP response.
+
+    Hashes everything read, so that streamed content can be compared to the previous one. """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+        self.hash = hashlib.blake2b()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.hash.update(chunk)
+            self.buffer += chunk
+        if size < 0:
+            data, self.buffer = self.buffer, b""
+        else:
+            # expat does not accept more data than it asked for
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
 
 
-class DateTimeEncoder(json.JSONEncoder):
-    """ Encodes items with datetime objects properly """
-
-    def default(self, o):
-        if isinstance(o, datetime.datetime):
-            return o.isoformat()
-
-        return json.JSONEncoder.default(self, o)
+def encode_datetime(o):
+    """ json.dumps default= hook for encoding datetime objects properly """
+    if isinstance(o, datetime.datetime):
+        return o.isoformat()
+    raise TypeError("Object of type %s is not JSON serializable" % type(o).__name__)
 
 
 class PoikkeusInfoParser(object):
@@ -34,63 +96,33 @@ class PoikkeusInfoParser(object):
     See http://developer.reittiopas.fi/media/Poikkeusinfo_XML_rajapinta_V2_2_01.pdf
     """
 
-    # Different time formats for estimated lengths
-    TIME_RE = [
-        re.compile(r"^(?P<start_time>([0-9]{1,2}:[0-9]{2})|([0-9]{1,2}))\s*-\s*(?P<end_date>[0-9]{1,2}\.[0-9]{2})\.{0,1}\s*(klo|kello)\.*\s*(?P<end_time>([0-9]{2}:[0-9]{2})|([0-9]{1,2}))"),
-        re.compile(r"^(?P<end_time>([0-9]{1,2}:[0-9]{2})|([0-9]{1,2}))\s*(asti|)(\.|)$"),
-        re.compile(r"^(?P<start_time>([0-9]{1,2}:[0-9]{2})|([0-9]{1,2}))\s*-\s*(?P<end_time>([0-9]{1,2}:[0-9]{2})|([0-9]{1,2}))"),
-    ]
-
-    # Formats for estimated length dates
-    DATE_FORMATS = [
-        "%d.%m",
-        "%d.%m.",
-        "%d.%m.%Y",
-        "%d..%m",
-        "%d..%m.%Y",
-    ]
-
-    # Formats for estimated length times
-    TIME_FORMATS = [
-        "%H:%M",
-        "%H",
-    ]
-
-    # Mapping for notification types (see pdf)
-    TYPE_MAP = {
-        "1": "advance_info",
-        "2": "urgent_info",
-    }
+    # Different time formats for estimated lengths, combined to a single regex.
+    # Alternatives are tried in order: "start - end_date klo end_time", "end_time asti" and "start - end_time".
+    TIME_RE = re.compile(
+        r"^(?:"
+        r"(?:(?P<start_time_a>([0-9]{1,2}:[0-9]{2})|([0-9]{1,2}))\s*-\s*(?P<end_date_a>[0-9]{1,2}\.[0-9]{2})\.{0,1}\s*(klo|kello)\.*\s*(?P<end_time_a>([0-9]{2}:[0-9]{2})|([0-9]{1,2})))"
+        r"|(?:(?P<end_time_b>([0-9]{1,2}:[0-9]{2})|([0-9]{1,2}))\s*(asti|)(\.|)$)"
+        r"|(?:(?P<start_time_c>([0-9]{1,2}:[0-9]{2})|([0-9]{1,2}))\s*-\s*(?P<end_time_c>([0-9]{1,2}:[0-9]{2})|([0-9]{1,2})))"
+        r")"
+    )
 
-    # Mapping for notification sources (see pdf)
-    SOURCE_MAP = {
-        "1": "manual",  # manually entered
-        "2": "automatic",  # automatically imported from other HSL systems
-    }
+    # Prefix for estimated length in freetext field
+    _LENGTH_MARKER = "Arvioitu kesto: "
 
-    # Mapping for line types (see pdf)
-    LINETYPE_MAP = {
-        "1": "helsinki",
-        "2": "tram",
-        "3": "espoo",
-        "4": "vantaa",
-        "5": "regional_traffic",
-        "6": "metro",
-        "7": "ferry",
-        "12": "train",
-        "14": "all",
-        "36": "kirkkonummi",
-        "39": "kerava",
-    }
+    # Timezone for all timestamps
+    _HELSINKI_TZ = ZoneInfo("Europe/Helsinki")
+
+    # Base for converting strptime results to timedeltas
+    _EPOCH_1900 = datetime.datetime(1900, 1, 1)
 
     # Regex for fetching reason phrase
     REASON_RE = re.compile(r".*Syy:\s*(?P<reason>[^\.]*)\.*")
 
-    # Mapping for departure directions (see pdf)
-    DIRECTION_MAP = {
-        "1": "from_centrum",
-        "2": "to_centrum",
-    }
+    # Mappings from XML values, see module level definitions
+    TYPE_MAP = TYPE_MAP
+    SOURCE_MAP = SOURCE_MAP
+    LINETYPE_MAP = LINETYPE_MAP
+    DIRECTION_MAP = DIRECTION_MAP
 
     # Mapping for reasons - some typo fixes and unifying.
     REASON_MAP = {
@@ -109,7 +141,6 @@ class PoikkeusInfoParser(object):
         "kulkue": "yleisötapahtuma",
         "juoksutapahtuma": "yleisötapahtuma",
         "virtahäiriö": "tekninen vika",
-        "Työnseisaus": "lakko",
         "tie poikki (viranomaisten toimesta)": "tie poikki",
         "työnseisaus": "lakko",
         "tietyömaa": "tietyö",
@@ -122,90 +153,94 @@ class PoikkeusInfoParser(object):
         "väärin pysäköity auito": "väärin pysäköity auto",
     }
 
+    # REASON_MAP with case-insensitive keys
+    _REASON_MAP_CF = {key.casefold(): value for key, value in REASON_MAP.items()}
+
     def parse_length(self, reason, timestamp):
         """ Parses 'estimated length' from freetext field """
+        return self._parse_length(reason, timestamp.year, timestamp.month, timestamp.day)
 
-        if "Arvioitu kesto: " not in reason:
+    @classmethod
+    @functools.lru_cache(maxsize=1024)
+    def _parse_length(cls, reason, year, month, day):
+        """ Cached implementation of parse_length. Only the date of the timestamp is relevant. """
+
+        _, separator, estimated_length = reason.partition(cls._LENGTH_MARKER)
+        if not separator:
             return None
 
-        helsinki = pytz.timezone("Europe/Helsinki")
+        match = cls.TIME_RE.match(estimated_length)
+        if not match:
+            return None
 
-        estimated_length = reason.split("Arvioitu kesto: ")[1]
-        for regex in self.TIME_RE:
-            match = regex.match(estimated_length)
-            if not match:
-                continue
+        if match.group("end_time_a") is not None:
+            end_date, end_time = match.group("end_date_a", "end_time_a")
+        else:
+            end_date = None
+            end_time = match.group("end_time_b") or match.group("end_time_c")
 
-            parsed_timestamp = datetime.datetime(1900, 1, 1)
+        parsed_timestamp = cls._EPOCH_1900
+        if end_date is not None:
             try:
-                end_date = match.group("end_date")
-                for date_format in self.DATE_FORMATS:
-                    try:
-                        day_part = datetime.datetime.strptime(end_date, date_format)
-                        parsed_timestamp += (day_part - datetime.datetime(1900, 1, 1))
-                        break
-                    except ValueError:
-                        pass
-            except IndexError:
-                parsed_timestamp += (datetime.datetime(1900, timestamp.month, timestamp.day) - datetime.datetime(1900, 1, 1))
-
-            for time_format in self.TIME_FORMATS:
-                try:
-                    time_part = datetime.datetime.strptime(match.group("end_time"), time_format)
-                    parsed_timestamp += (time_part - datetime.datetime(1900, 1, 1))
-                    parsed_timestamp += (datetime.datetime(timestamp.year, 1, 1) - datetime.datetime(1900, 1, 1))
-                    return helsinki.localize(parsed_timestamp)
-                except ValueError:
-                    pass
-        return None
-
-    def parse_reason(self, text):
+                day_part = datetime.datetime.strptime(end_date, "%d.%m")
+                parsed_timestamp += (day_part - cls._EPOCH_1900)
+            except ValueError:
+                pass
+        else:
+            parsed_timestamp += (datetime.datetime(1900, month, day) - cls._EPOCH_1900)
+
+        try:
+            time_part = datetime.datetime.strptime(end_time, "%H:%M" if ":" in end_time else "%H")
+        except ValueError:
+            # Invalid end time (such as 99:99) is not retried with the other TIME_RE alternatives
+            return None
+        parsed_timestamp += (time_part - cls._EPOCH_1900)
+        parsed_timestamp += (datetime.datetime(year, 1, 1) - cls._EPOCH_1900)
+        return parsed_timestamp.replace(tzinfo=cls._HELSINKI_TZ)
+
+    @classmethod
+    @functools.lru_cache(maxsize=1024)
+    def parse_reason(cls, text):
         """ Parses reason information from freetext field, if available. Returns None if no match is found. """
-        match = self.REASON_RE.match(text)
-        if match:
-            reason = match.group("reason").encode("utf-8").strip()
-            reason = self.REASON_MAP.get(reason, reason)
-            return reason
-        return None
+        match = cls.REASON_RE.match(text)
+        if not match:
+            return None
+        reason = match.group("reason").strip()
+        return cls._REASON_MAP_CF.get(reason.casefold(), reason)
 
     def parse_info(self, info, timestamp):
         """ Parses info field, including length and reason """
-        text_item = None
-        if isinstance(info["TEXT"], list):
-            for item in info["TEXT"]:
-                if item["@lang"] == "fi":
-                    text_item = item
-                    break
-        elif "TEXT" in info:
-            text_item = info["TEXT"]
-        if text_item:
-            if "#text" in text_item:
-                data = {
-                    "length": self.parse_length(text_item["#text"], timestamp),
-                    "reason": self.parse_reason(text_item["#text"]),
-                    "text": text_item["#text"],
-                }
-                return data
-        return None
-
-    def parse_targets(self, targets):
+        if not info:
+            return None
+        text_item = info.get("TEXT")
+        if isinstance(text_item, list):
+            text_item = next((item for item in text_item if item.get("@lang") == "fi"), None)
+        if not text_item or "#text" not in text_item:
+            return None
+        text = text_item["#text"]
+        data = {
+            "length": self.parse_length(text, timestamp),
+            "reason": self.parse_reason(text),
+            "text": text,
+        }
+        return data
+
+    def parse_targets(self, targets, _direction_map=DIRECTION_MAP, _linetype_map=LINETYPE_MAP):
         """ Parses targets (affected lines) """
         if targets is None:
             return None
-        lines = []
-        for k, target in targets.items():
-            if k == "LINE":
-                if not isinstance(target, list):
-                    target = [target]
-                for line in target:
-                    lines.append({"id": line["@id"], "direction": self.DIRECTION_MAP.get(line["@direction"]), "type": self.LINETYPE_MAP.get(line["@linetype"]), "number": line["#text"]})
-        return lines
-
-    @classmethod
-    def parse_isoformat(cls, time_string):
+        target = targets.get("LINE")
+        if target is None:
+            return []
+        if not isinstance(target, list):
+            target = [target]
+        return [{"id": line["@id"], "direction": _direction_map.get(line["@direction"]), "type": _linetype_map.get(line["@linetype"]), "number": line["#text"]} for line in target]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def parse_isoformat(time_string):
         """ Parses ISO-8601 datetimes (without timezone) to python datetime """
-        helsinki = pytz.timezone("Europe/Helsinki")
-        return helsinki.localize(datetime.datetime.strptime(time_string, "%Y-%m-%dT%H:%M:%S"))
+        return datetime.datetime.fromisoformat(time_string).replace(tzinfo=PoikkeusInfoParser._HELSINKI_TZ)
 
     def parse_validity(self, validity):
         """ Parses notification validity timestamps and "valid" tag.
@@ -218,55 +253,77 @@ class PoikkeusInfoParser(object):
         }
         return data
 
-    def parse_item(self, item, timestamp):
+    def parse_item(self, item, timestamp, _type_map=TYPE_MAP, _source_map=SOURCE_MAP):
         """ Parses a single deserialized item """
         data = {
             "id": item["@id"],
-            "type": self.TYPE_MAP[item["@type"]],
-            "source": self.SOURCE_MAP[item["@source"]],
+            "type": _type_map[item["@type"]],
+            "source": _source_map[item["@source"]],
             "info": self.parse_info(item["INFO"], timestamp),
             "lines": self.parse_targets(item["TARGETS"]),
             "validity": self.parse_validity(item["VALIDITY"]),
         }
         return data
 
+    @staticmethod
+    def skip_foreign_text(path, key, value):
+        """ xmltodict postprocessor for dropping non-finnish TEXT items already while parsing """
+        if key == "TEXT" and isinstance(value, dict) and value.get("@lang") not in (None, "fi"):
+            return None
+        return key, value
+
     def parse(self, content, timestamp):
         """ Parses XML from poikkeusinfo.fi """
-        parsed = xmltodict.parse(content)
-        if "DISRUPTIONS" not in parsed:
-            return
-        parsed = parsed["DISRUPTIONS"]
         items = []
-        if "DISRUPTION" in parsed:
-            disruptions = parsed["DISRUPTION"]
-            if not isinstance(disruptions, list):
-                disruptions = [disruptions]
-            for item in disruptions:
-                items.append(self.parse_item(item, timestamp))
+
+        def handle_item(path, item):
+            """ Called by xmltodict for each child of the root element, so the full tree is never built """
+            if path[0][0] != "DISRUPTIONS" or path[-1][0] != "DISRUPTION":
+                return True
+            # In streaming mode, attributes of the item itself are only available in the path
+            disruption = {"@" + key: value for key, value in (path[-1][1] or {}).items()}
+            disruption.update(item or {})
+            items.append(self.parse_item(disruption, timestamp))
+            return True
+
+        xmltodict.parse(content, dict_constructor=dict, postprocessor=self.skip_foreign_text,
+                        item_depth=2, item_callback=handle_item)
         return items
 
 
 class PoikkeusInfoFilter(object):
     """ Filters entries based on configuration dictionary. """
 
+    # Wildcard for fields not set in the configuration
+    ANY = object()
+
     def __init__(self, config):
         self.config = config
+        # (line_type, direction, number) => (position in config, display name)
+        self.index = {}
+        for position, (line_name, line_config) in enumerate(config.items()):
+            line_types = [line_config["line_type"]] if "line_type" in line_config else [self.ANY]
+            directions = line_config.get("directions", [self.ANY])
+            numbers = line_config.get("numbers", [self.ANY])
+            for key in itertools.product(line_types, directions, numbers):
+                self.index.setdefault(key, (position, line_name))
 
     def filter_item(self, item):
         """ Checks whether a single item should be included. Returns either None or item """
 
         if not item["validity"]["valid"] or item["lines"] is None:
             return None
-        for line_name, config in self.config.items():
-            for filter_by in item["lines"]:
-                if "line_type" in config and filter_by["type"] != config["line_type"]:
-                    continue
-                if "directions" in config and filter_by["direction"] not in config["directions"]:
-                    continue
-                if "numbers" in config and filter_by["number"] not in config["numbers"]:
-                    continue
-                item["display_name"] = line_name
-                return item
+        match = None
+        for line in item["lines"]:
+            for key in itertools.product((line["type"], self.ANY), (line["direction"], self.ANY), (line["number"], self.ANY)):
+                found = self.index.get(key)
+                # If multiple configuration entries match, the first one wins
+                if found is not None and (match is None or found < match):
+                    match = found
+        if match is None:
+            return None
+        item["display_name"] = match[1]
+        return item
 
     def filter(self, lines):
         """ Filters a list of items. """
@@ -288,7 +345,15 @@ class PoikkeusInfoRunner(object):
     def __init__(self):
         self.pip = PoikkeusInfoParser()
         self.pif = PoikkeusInfoFilter(LINES)
-        self.redis_instance = redis.StrictRedis()
+        self.redis_instance = redis.asyncio.Redis()
+        # Shared session keeps the connection alive between fetches
+        self.session = requests.Session()
+        # Validators and results of the previous fetch, for skipping unchanged content
+        self.etag = None
+        self.last_modified = None
+        self.content_hash = None
+        self.last_filtered = None
+        self.last_dumped = None
         self.last_run_at = None
         self.logger = logging.getLogger("poikkeusinfo-runner")
         self.logger.setLevel(logging.INFO)
@@ -298,48 +363,99 @@ class PoikkeusInfoRunner(object):
         ch.setFormatter(formatter)
         self.logger.addHandler(ch)
 
-    def fetch(self):
-        """ A single fetch. Returns False on failure. Saves and publishes updates to redis. """
+    async def fetch(self):
+        """ A single fetch. Returns False on failure. Saves and publishes updates to redis.
 
-        resp = requests.get("http://www.poikkeusinfo.fi/xml/v2/fi")
-        if resp.status_code != 200:
-            self.logger.info("Fetching failed with status code %s", resp.status_code)
+        Blocking HTTP request and CPU bound parsing are run in a worker thread to keep the event loop free. """
+
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        try:
+            resp = await asyncio.to_thread(self.session.get, "http://www.poikkeusinfo.fi/xml/v2/fi", headers=headers, stream=True, timeout=(3, 10))
+        except requests.RequestException as err:
+            self.logger.info("Fetching failed: %s", err)
             return False
-        parsed = self.pip.parse(resp.content, datetime.datetime.now())
-        filtered = self.pif.filter(parsed)
-        dumped = json.dumps(filtered, cls=DateTimeEncoder)
-        self.redis_instance.setex("hsl-poikkeusinfo", 3600, dumped)
-        self.redis_instance.publish("home:broadcast:generic", json.dumps({"key": "poikkeusinfo", "content": filtered}, cls=DateTimeEncoder))
+        with resp:
+            if resp.status_code == 304:
+                return await self.keep_unchanged()
+            if resp.status_code != 200:
+                self.logger.info("Fetching failed with status code %s", resp.status_code)
+                return False
+            # Body is parsed while it is being downloaded
+            content = HashingStreamReader(resp.iter_content(chunk_size=8192))
+            try:
+                filtered = await asyncio.to_thread(self.parse_and_filter, content)
+            except requests.RequestException as err:
+                self.logger.info("Fetching failed: %s", err)
+                return False
+        # Server does not necessarily support conditional requests, so check the content as well.
+        # Unchanged content is not published again: subscribers only get a message when content changes.
+        content_hash = content.hash.digest()
+        if content_hash == self.content_hash:
+            self.etag = resp.headers.get("ETag")
+            self.last_modified = resp.headers.get("Last-Modified")
+            return await self.keep_unchanged()
+        dumped = json.dumps(filtered, default=encode_datetime, separators=(",", ":"))
+        pipe = self.redis_instance.pipeline(transaction=False)
+        pipe.setex("hsl-poikkeusinfo", 3600, dumped)
+        # Embed already serialized content instead of encoding everything again
+        pipe.publish("home:broadcast:generic", '{"key":"poikkeusinfo","content":' + dumped + '}')
+        await pipe.execute()
+        # Only remember validators after a successful publish
+        self.etag = resp.headers.get("ETag")
+        self.last_modified = resp.headers.get("Last-Modified")
+        self.content_hash = content_hash
+        self.last_filtered = filtered
+        self.last_dumped = dumped
         return filtered
 
-    def run(self):
+    def parse_and_filter(self, content):
+        """ Parses and filters downloaded XML. content can be either a string or a file-like object. """
+        parsed = self.pip.parse(content, datetime.datetime.now())
+        return self.pif.filter(parsed)
+
+    async def keep_unchanged(self):
+        """ Skips parsing and publishing when content has not changed since the previous fetch.
+
+        Stored content is still written again, in case the key has disappeared from redis. """
+        self.logger.info("Content not changed")
+        await self.redis_instance.setex("hsl-poikkeusinfo", 3600, self.last_dumped)
+        return self.last_filtered
+
+    async def run(self):
         """ Runner for periodic fetching and publishing. Configure interval with FETCH_INTERVAL variable. """
-        self.last_run_at = time.time()
         while True:
+            self.last_run_at = time.time()
             self.logger.info("Starting")
-            self.fetch()
+            await self.fetch()
             sleep_time = max(FETCH_INTERVAL / 2, FETCH_INTERVAL - (time.time() - self.last_run_at))
             self.logger.info("Sleeping %ss", sleep_time)
-            time.sleep(sleep_time)
+            await asyncio.sleep(sleep_time)
 
 
-def main_testing():
-    """ Runs all .xml files and prints the results """
+def parse_file(filename):
+    """ Parses and filters a single .xml file """
     pip = PoikkeusInfoParser()
     pif = PoikkeusInfoFilter(LINES)
-    for filename in glob.glob("*.xml"):
-        timestamp = datetime.datetime.now()
-        content = open(filename).read()
-        parsed = pip.parse(content, timestamp)
-        filtered = pif.filter(parsed)
-        if len(filtered) > 0:
-            pprint.pprint(filtered)
+    parsed = pip.parse(pathlib.Path(filename).read_bytes(), datetime.datetime.now())
+    return pif.filter(parsed)
+
+
+def main_testing():
+    """ Runs all .xml files and prints the results. Files are processed in parallel. """
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        for filtered in executor.map(parse_file, glob.glob("*.xml")):
+            if len(filtered) > 0:
+                pprint.pprint(filtered)
 
 
 def main_run():
     """ Starts periodic download/parse/filter/publish cycle in foreground """
     pir = PoikkeusInfoRunner()
-    pir.run()
+    asyncio.run(pir.run())
 
 if __name__ == '__main__':
     main_run()